@@ -1,84 +1,272 @@
 
-import argparse
+import mmap
+import os
 import pathlib
-import re
+import sys
+from array import array
+from bisect import bisect_right
 from os import path
-from typing import List, Union
-
-from virtual_printer import VirtualPrinter, create_printer
-
-parser = argparse.ArgumentParser(
-    prog='resume_print',
-    description='Resume a 3D print based on your OctoPrint Terminal output.',
-)
-
-parser.add_argument("gcode", type=pathlib.Path)
-parser.add_argument('-l', '--log', type=pathlib.Path,
-                    help="OctoPrint log file", required=True)
-parser.add_argument('-o', '--out', type=pathlib.Path,
-                    help="output file", required=True)
-parser.add_argument('--home', action='store_true', default=False)
-parser.add_argument('--heat', action='store_true', default=False)
-parser.add_argument('--keep', type=int, default=0)
-parser.add_argument('--prime', action='store_true', default=False)
-parser.add_argument('--fan', action='store_true', default=False)
-parser.add_argument('--prime-start', type=str, default="0.1,20,0.3")
-parser.add_argument('--prime-end', type=str, default="0.1,180,0.3")
-parser.add_argument('--lines', type=int,
-                    help="use the last n lines of sent gcode to find the failure position", default=5)
-
-
-def linenr_of(file_path: str, search_str: str) -> int:
-    with open(file_path, 'r') as f:
-        content = f.read()
-        index = content.index(search_str)
-        if index == -1:
-            return -1
-        return len(content[0:index].split("\n"))
-
-
-gcode_pattern = re.compile(r"G\d+.*\*")
-
-
-def gcode_in_log(file_path: str) -> List[str]:
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+from virtual_printer import (VirtualPrinter, create_printer, g0, g28, g92,
+                             m104, m106, m140)
+
+
+def build_parser():
+    # argparse is only needed when run as a script
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='resume_print',
+        description='Resume a 3D print based on your OctoPrint Terminal output.',
+    )
+
+    parser.add_argument("gcode", type=pathlib.Path)
+    parser.add_argument('-l', '--log', type=pathlib.Path,
+                        help="OctoPrint log file", required=True)
+    parser.add_argument('-o', '--out', type=pathlib.Path,
+                        help="output file", required=True)
+    parser.add_argument('--home', action='store_true', default=False)
+    parser.add_argument('--heat', action='store_true', default=False)
+    parser.add_argument('--keep', type=int, default=0)
+    parser.add_argument('--prime', action='store_true', default=False)
+    parser.add_argument('--fan', action='store_true', default=False)
+    parser.add_argument('--prime-start', type=str, default="0.1,20,0.3")
+    parser.add_argument('--prime-end', type=str, default="0.1,180,0.3")
+    parser.add_argument('--lines', type=int,
+                        help="use the last n lines of sent gcode to find the failure position", default=5)
+
+    return parser
+
+
+def linenr_of(mm: mmap.mmap, offsets: array, search_str: Union[str, bytes]) -> int:
+    needle = search_str.encode() if isinstance(search_str, str) else search_str
+    index = mm.find(needle)
+    if index == -1 and b'\n' in needle:
+        # the search lines are joined by "\n", retry for CRLF files
+        index = mm.find(needle.replace(b'\n', b'\r\n'))
+    if index == -1:
+        return -1
+    return bisect_right(offsets, index)
+
+
+def _sent_gcode(line: bytes) -> bytes:
+    # lines look like "Send: N123 G1 X1.0 Y2.0*56", the command starts at a
+    # fixed offset or right after the line number
+    start = 6
+    if line[6:7] == b'N':
+        start = line.find(b' ', 6) + 1 or len(line)
+    end = line.rfind(b'*')
+    if end < start:
+        end = len(line.rstrip())
+    return line[start:end]
+
+
+_log_dispatch = {b'Send': _sent_gcode, b'Recv': None}
+_end_of_log = object()
+
+
+def gcode_in_log(file_path: str) -> List[bytes]:
     gcode = []
-    with open(file_path, 'r') as f:
+    gcode_append = gcode.append
+    dispatch_get = _log_dispatch.get
+    with open(file_path, 'rb', buffering=1 << 20) as f:
         for line in f:
-            if line.startswith('Send'):
-                m = gcode_pattern.search(line)
-                gcode.append(line[m.start():m.end()-1])
+            handler = dispatch_get(line[:4], _end_of_log)
+            if handler is None:
                 continue
-            if line.startswith('Recv'):
-                continue
-            break
+            if handler is _end_of_log:
+                break
+            gcode_append(handler(line))
     return gcode
 
 
-def run_gcode(printer: VirtualPrinter, gcode: List[str]):
+def run_gcode(printer: VirtualPrinter, gcode: Iterable[bytes]):
+    process_bytes = printer.process_bytes
     for line in gcode:
-        printer.process_line(line)
+        process_bytes(line)
+
+
+def line_offsets(mm: mmap.mmap) -> array:
+    # byte offset of every line start, terminated by the file size
+    offsets = array('q', [0])
+    append = offsets.append
+    pos = mm.find(b'\n')
+    while pos != -1:
+        pos += 1
+        append(pos)
+        pos = mm.find(b'\n', pos)
+    if offsets[-1] != len(mm):
+        append(len(mm))
+    return offsets
+
+
+def iter_lines(mm: mmap.mmap, offsets: array, start: int = 0, end: int = None) -> Iterator[bytes]:
+    last = len(offsets) - 1
+    end = last if end is None else min(end, last)
+    for i in range(start, end):
+        yield mm[offsets[i]:offsets[i+1]]
+
+
+def _strip_line(line: bytes) -> bytes:
+    # the command part of a line, as VirtualPrinter.process_bytes reads it
+    return line.partition(b';')[0].strip()
+
+
+def find_last(mm: mmap.mmap, cmd: bytes, end: int) -> int:
+    # offset of the last line before end whose command is cmd, or -1
+    pos = mm.rfind(cmd, 0, end)
+    while pos != -1:
+        start = mm.rfind(b'\n', 0, pos) + 1
+        stop = mm.find(b'\n', pos, end)
+        line = _strip_line(mm[start:end if stop == -1 else stop])
+        if line.partition(b" ")[0] == cmd:
+            return start
+        pos = mm.rfind(cmd, 0, start)
+    return -1
+
+
+def _parse_line(printer: VirtualPrinter, line: bytes) -> Tuple[bytes, object, Dict[str, float]]:
+    # func is the handler the command was registered with
+    gcode = _strip_line(line)
+    cmd = gcode.partition(b" ")[0]
+    entry = printer._dispatch.get(cmd)
+    if entry is None:
+        return cmd, None, {}
+    parse, _ = entry
+    return cmd, printer.instruction_set[cmd.decode()].func, parse(gcode)
+
+
+_mode_cmds = (b'G90', b'G91', b'M82', b'M83')
+
+
+def _modes(last: Dict[bytes, int]) -> Tuple[bool, bool]:
+    # (abs_mode, abs_e_mode) given the offset of the last line of each mode command
+    g90_pos, g91_pos, m82_pos, m83_pos = (last[cmd] for cmd in _mode_cmds)
+    return g91_pos <= g90_pos, max(g91_pos, m83_pos) <= max(g90_pos, m82_pos)
+
+
+_positions = {'X': 'x', 'Y': 'y', 'Z': 'z', 'E': 'e', 'F': 'feed_rate'}
+_settings = ((m104, 'hotend_temp'), (m140, 'bed_temp'), (m106, 'fan_speed'))
+
+
+def scan_state(printer: VirtualPrinter, mm: mmap.mmap, offsets: array, end: int) -> bool:
+    """Derive the printer state after the first end lines without replaying them.
+
+    Temperatures and fan speed are taken from the last command setting them.
+    Positions are resolved by walking the lines backwards until every axis
+    has been set by an absolute move, G92 or G28, collecting relative moves
+    on the way. Returns False and leaves the printer untouched if an axis
+    was moved relatively without ever being set, in which case the lines
+    have to be replayed with run_gcode.
+    """
+    end = min(end, len(offsets) - 1)
+    end_offset = offsets[end]
+
+    # offset of the last line of each mode command the walk has not passed yet
+    last = {cmd: find_last(mm, cmd, end_offset) for cmd in _mode_cmds}
+    modes = abs_mode, abs_e_mode = _modes(last)
+
+    state = {}
+    pending = set(_positions)
+    # relative moves per axis, latest first
+    deltas = {key: [] for key in _positions}
+    relative = set()
+
+    def resolve(key, value):
+        # apply the relative moves in file order, like a replay would
+        for delta in reversed(deltas[key]):
+            value += delta
+        state[_positions[key]] = value
+        pending.remove(key)
+
+    for i in range(end - 1, -1, -1):
+        cmd, func, args = _parse_line(printer, mm[offsets[i]:offsets[i+1]])
+        if func is g0:
+            for key in pending.intersection(args):
+                if key == 'F' or (abs_e_mode if key == 'E' else abs_mode):
+                    resolve(key, args[key])
+                else:
+                    deltas[key].append(args[key])
+            if not abs_mode:
+                relative.update(pending.intersection('XYZ'))
+            if not abs_e_mode and 'E' in pending:
+                relative.add('E')
+        elif func is g92:
+            for key in pending.intersection(args):
+                resolve(key, args[key])
+        elif func is g28:
+            for key in pending.intersection('XYZ'):
+                resolve(key, 0)
+        elif cmd in last:
+            # only the command on this line has to be searched further back
+            last[cmd] = find_last(mm, cmd, offsets[i])
+            abs_mode, abs_e_mode = _modes(last)
+        if not pending:
+            break
 
+    if relative.intersection(pending):
+        return False
 
-def read_lines(file_path: pathlib.Path, start: int = 0, end: int = None) -> List[str]:
-    lines = []
-    with open(file_path, 'r') as f:
-        for line_number, line in enumerate(f):
-            if end != None and end <= line_number:
+    for func, attr in _settings:
+        cmds = [cmd.encode() for cmd, instr in printer.instruction_set.items()
+                if instr.func is func]
+        stop = end_offset
+        while cmds:
+            pos = max(find_last(mm, cmd, stop) for cmd in cmds)
+            if pos == -1:
                 break
-            if start <= line_number:
-                lines.append(line.strip())
-
-    return lines
-
-
-def parse_pos(pos: str) -> List[int]:
-    return list(map(float, pos.split(',')))
-
-
-def gen_start_gcode(args, printer: VirtualPrinter) -> List[str]:
+            nl = mm.find(b'\n', pos, stop)
+            _, _, args = _parse_line(printer, mm[pos:stop if nl == -1 else nl])
+            if 'S' in args:
+                state[attr] = args['S']
+                break
+            stop = pos
+
+    for attr, value in state.items():
+        setattr(printer, attr, value)
+    printer.abs_mode, printer.abs_e_mode = modes
+    return True
+
+
+def write_output(file_path: pathlib.Path, prologue: bytes, source: mmap.mmap, offset: int):
+    # write prologue followed by source[offset:] with as few syscalls as
+    # possible, writev may stop early so the written part is dropped and the
+    # rest is retried. the views are released before returning, otherwise
+    # source can not be closed while an error propagates
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                 getattr(os, 'O_BINARY', 0), 0o666)
+    buffers = []
+    try:
+        with memoryview(source) as view:
+            buffers += [memoryview(prologue), view[offset:]]
+            while buffers:
+                if hasattr(os, 'writev'):
+                    written = os.writev(fd, buffers)
+                else:
+                    written = os.write(fd, buffers[0])
+                while buffers and written >= len(buffers[0]):
+                    written -= len(buffers[0])
+                    buffers.pop(0).release()
+                if buffers:
+                    rest = buffers[0][written:]
+                    buffers[0].release()
+                    buffers[0] = rest
+    finally:
+        for b in buffers:
+            b.release()
+        os.close(fd)
+
+
+def parse_pos(pos: str) -> Tuple[float, float, float]:
+    x, y, z = pos.split(',')
+    return (float(x), float(y), float(z))
+
+
+def gen_start_gcode(args, printer: VirtualPrinter, head: List[str]) -> List[str]:
     gcode = ['; start gcode']
     if (args.keep > 0):
-        gcode += read_lines(args.gcode, end=args.keep)
+        gcode += head
 
     if (args.home):
         gcode.append("G28")
@@ -111,33 +299,44 @@ def gen_start_gcode(args, printer: VirtualPrinter) -> List[str]:
 
 
 if __name__ == '__main__':
-    args = parser.parse_args()
+    args = build_parser().parse_args()
     last_gcode = gcode_in_log(args.log)
 
-    search_str = "\n".join(last_gcode[-args.lines:])
+    search_str = b"\n".join(last_gcode[-args.lines:])
     print("Using the following gcode to locate the position of failure:")
-    print(search_str+"\n")
+    print(search_str.decode()+"\n")
+
+    with open(args.gcode, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        offsets = line_offsets(mm)
 
-    linenr = linenr_of(args.gcode, search_str) + args.lines - 1
-    print(f"resuming at line number: {linenr}\n")
+        linenr = linenr_of(mm, offsets, search_str)
+        if linenr == -1:
+            sys.exit("could not locate the failure position in the gcode file")
+        linenr += args.lines - 1
+        print(f"resuming at line number: {linenr}\n")
 
-    printer = create_printer()
-    run_gcode(printer, read_lines(args.gcode, end=linenr))
-    print("Lastest printer state:")
-    printer.print_status()
+        printer = create_printer()
+        if not scan_state(printer, mm, offsets, linenr):
+            run_gcode(printer, iter_lines(mm, offsets, end=linenr))
+        print("Lastest printer state:")
+        printer.print_status()
 
-    gcode = gen_start_gcode(args, printer)
+        head = [line.strip().decode()
+                for line in iter_lines(mm, offsets, end=args.keep)]
+        gcode = gen_start_gcode(args, printer, head)
 
-    # resume print
-    gcode += [
-        "; resume print",
-        f"G0 Z{printer.z+2} F{printer.feed_rate} ;Move up",
-        f"G92 E{printer.e} ;Set extruder",
-        f"G0 X{printer.x} Y{printer.y} Z{printer.z} ;Move to start position",
-    ]
+        # resume print
+        gcode += [
+            "; resume print",
+            f"G0 Z{printer.z+2} F{printer.feed_rate} ;Move up",
+            f"G92 E{printer.e} ;Set extruder",
+            f"G0 X{printer.x} Y{printer.y} Z{printer.z} ;Move to start position",
+        ]
 
-    gcode.append("; Remaining gcode")
-    gcode += read_lines(args.gcode, start=linenr)
+        gcode.append("; Remaining gcode")
 
-    with open(args.out, 'w') as f:
-        f.write("\n".join(gcode))
+        # the remaining gcode is written verbatim from the mapped file
+        prologue = ("\n".join(gcode) + "\n").encode()
+        write_output(args.out, prologue, mm,
+                     offsets[min(linenr, len(offsets) - 1)])
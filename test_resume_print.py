@@ -0,0 +1,144 @@
+import mmap
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from resume_print import gcode_in_log, line_offsets, linenr_of, write_output
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BUNDLED_GCODE = os.path.join(HERE, 'CE3_Flexi-Horse.gcode')
+BUNDLED_LOG = os.path.join(HERE, 'octo_terminal.txt')
+
+
+class TempFileTestCase(unittest.TestCase):
+
+    def write(self, content: bytes, suffix='.gcode'):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+
+class GCodeInLogTest(TempFileTestCase):
+
+    def test_sent_gcode(self):
+        log = self.write(
+            b'Recv: ok\n'
+            b'Send: N145771 G0 F6000 X91.493 Y119.455*66\n'
+            b'Recv: T:210.0 /210.0 B:60.0 /60.0\n'
+            b'Send: M105\n'
+            b'Send: N12 M105*30\r\n'
+            b'Send: G28 X  \r\n'
+            b'Send: M117 a*b*7\n'
+            b'Send: N13\n', suffix='.txt')
+        self.assertEqual(gcode_in_log(log), [
+            b'G0 F6000 X91.493 Y119.455', b'M105', b'M105', b'G28 X',
+            b'M117 a*b', b''])
+
+    def test_stops_at_other_lines(self):
+        log = self.write(b'Send: G28\nRecv: ok\nChanging monitoring state\n'
+                         b'Send: G1 X1\n', suffix='.txt')
+        self.assertEqual(gcode_in_log(log), [b'G28'])
+
+
+class LinenrOfTest(TempFileTestCase):
+
+    def linenr_of(self, content: bytes, search):
+        with open(self.write(content), 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return linenr_of(mm, line_offsets(mm), search)
+
+    def test_first_line(self):
+        self.assertEqual(self.linenr_of(b'G28\nG1 X1\n', b'G28'), 1)
+
+    def test_multiple_lines(self):
+        content = b'G28\nG1 X1\nG1 X2\nG1 X3\n'
+        self.assertEqual(self.linenr_of(content, b'G1 X2\nG1 X3'), 3)
+        self.assertEqual(self.linenr_of(content, 'G1 X1\nG1 X2'), 2)
+
+    def test_not_found(self):
+        self.assertEqual(self.linenr_of(b'G28\nG1 X1\n', b'G1 X2'), -1)
+
+    def test_crlf(self):
+        content = b'G28\r\nG1 X1\r\nG1 X2\r\nG1 X3\r\n'
+        self.assertEqual(self.linenr_of(content, b'G1 X2'), 3)
+        self.assertEqual(self.linenr_of(content, b'G1 X1\nG1 X2\nG1 X3'), 2)
+
+
+class WriteOutputTest(TempFileTestCase):
+
+    SOURCE = b'G28\nG1 X1\nG1 X2\nG1 X3\n'
+
+    def write_output(self, offset):
+        out = self.write(b'')
+        with open(self.write(self.SOURCE), 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            write_output(out, b'; prologue\n', mm, offset)
+        with open(out, 'rb') as f:
+            return f.read()
+
+    def test_write(self):
+        self.assertEqual(self.write_output(4), b'; prologue\nG1 X1\nG1 X2\nG1 X3\n')
+        self.assertEqual(self.write_output(len(self.SOURCE)), b'; prologue\n')
+
+    def test_partial_writes(self):
+        def writev(fd, buffers):
+            # write at most 3 bytes of the first buffer per call
+            with buffers[0][:3] as view:
+                return os.write(fd, view)
+        with mock.patch.object(os, 'writev', side_effect=writev, create=True) as m:
+            self.assertEqual(self.write_output(4), b'; prologue\nG1 X1\nG1 X2\nG1 X3\n')
+        self.assertEqual(m.call_count, 10)
+
+    def test_without_writev(self):
+        writev = getattr(os, 'writev', None)
+        if writev is not None:
+            del os.writev
+            self.addCleanup(setattr, os, 'writev', writev)
+        self.assertEqual(self.write_output(4), b'; prologue\nG1 X1\nG1 X2\nG1 X3\n')
+
+    def test_error_releases_source(self):
+        # mmap.close raises BufferError while views on it are alive
+        with open(self.write(self.SOURCE), 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with mock.patch.object(os, 'writev', side_effect=OSError('disk full'),
+                                   create=True), \
+                    mock.patch.object(os, 'write', side_effect=OSError('disk full')):
+                with self.assertRaisesRegex(OSError, 'disk full'):
+                    write_output(self.write(b''), b'', mm, 0)
+            mm.close()
+
+
+@unittest.skipUnless(os.path.exists(BUNDLED_GCODE), 'no bundled gcode')
+class ResumePrintTest(TempFileTestCase):
+
+    def resume(self, gcode_path):
+        out = self.write(b'')
+        result = subprocess.run(
+            [sys.executable, os.path.join(HERE, 'resume_print.py'), gcode_path,
+             '--log', BUNDLED_LOG, '--out', out, '--keep', '21'],
+            capture_output=True, check=True)
+        with open(out, 'rb') as f:
+            return result.stdout.decode(), f.read()
+
+    def test_bundled_gcode(self):
+        stdout, out = self.resume(BUNDLED_GCODE)
+        self.assertIn('resuming at line number: 148278', stdout)
+        with open(BUNDLED_GCODE, 'rb') as f:
+            tail = f.read().split(b'\n')[148278:]
+        self.assertTrue(out.endswith(b'; Remaining gcode\n' + b'\n'.join(tail)))
+
+    def test_crlf_gcode(self):
+        with open(BUNDLED_GCODE, 'rb') as f:
+            crlf = self.write(f.read().replace(b'\n', b'\r\n'))
+        stdout, out = self.resume(crlf)
+        self.assertIn('resuming at line number: 148278', stdout)
+        self.assertIn('X:72.536, Y:123.124, Z:10.72, E:2650.89136', stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import mmap
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+import resume_print
+from resume_print import iter_lines, line_offsets, scan_state
+from virtual_printer import create_printer
+
+STATE = ('x', 'y', 'z', 'e', 'feed_rate', 'bed_temp', 'hotend_temp',
+         'fan_speed', 'abs_mode', 'abs_e_mode')
+
+BUNDLED_GCODE = os.path.join(os.path.dirname(__file__), 'CE3_Flexi-Horse.gcode')
+
+
+def state_of(printer):
+    return [getattr(printer, attr) for attr in STATE]
+
+
+def synthetic_gcode(seed, relative=True, newline="\n"):
+    r = random.Random(seed)
+    modes = ["G90", "M82", "G90 ; abs", "  G90", "\tM82"]
+    if relative:
+        modes += ["G91", "M83", "  G91", "\tM83 ;rel"]
+    lines = ["G28", "G92 E0"]
+    for _ in range(600):
+        c = r.random()
+        if c < 0.5:
+            line = f"G1 X{r.randint(0, 200)} Y{r.randint(0, 200)} E{r.random():.3f}"
+            if r.random() < 0.2:
+                line += f" Z{r.random():.2f}"
+        elif c < 0.6:
+            line = f"G0 F{r.randint(100, 9000)} X{r.randint(0, 9)} ;move"
+        elif c < 0.66:
+            line = r.choice([
+                "G92 E0", "G92 X1 Y2", "G28", "G28 X", "M104", "M104 S200",
+                "  M104 S205", "M109 S210", "M140 S50", "\tM140 S55",
+                "M190 S60 ; bed", "M106 S3", "  M106 S7", "M106",
+                "  ; indented", ";G91 comment", "M1040 S4", "G900", "",
+            ])
+        elif c < 0.68:
+            line = r.choice(modes)
+        else:
+            line = "; comment"
+        lines.append(line)
+    return newline.join(lines)
+
+
+def zhop_gcode(blocks, with_m82=True):
+    # moves with a relative z-hop every 20 lines, z is never set absolutely
+    lines = ["M82" if with_m82 else ";", "G28", "G92 E0"]
+    e = 0
+    for i in range(blocks):
+        for j in range(17):
+            e += 0.01
+            lines.append(f"G1 X{j} Y{i % 200} E{e:.3f}")
+        lines += ["G91", "G1 Z0.2", "G90"]
+    return "\n".join(lines) + "\n"
+
+
+class ScanStateTest(unittest.TestCase):
+
+    def assert_matches_replay(self, path, ends=None):
+        with open(path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offsets = line_offsets(mm)
+            count = len(offsets) - 1
+            ends = set(range(count + 1) if ends is None else ends)
+
+            replay = create_printer()
+            for end, line in enumerate(iter_lines(mm, offsets)):
+                if end in ends:
+                    self.assert_scan(mm, offsets, end, replay)
+                replay.process_bytes(line)
+            if count in ends:
+                self.assert_scan(mm, offsets, count, replay)
+
+    def assert_scan(self, mm, offsets, end, replay):
+        printer = create_printer()
+        if scan_state(printer, mm, offsets, end):
+            self.assertEqual(state_of(printer), state_of(replay),
+                             f'state after {end} lines')
+        else:
+            self.assertEqual(state_of(printer), state_of(create_printer()),
+                             f'printer touched after {end} lines')
+
+    def write(self, content):
+        fd, path = tempfile.mkstemp(suffix='.gcode')
+        with os.fdopen(fd, 'w', newline='') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_mixed_modes(self):
+        for seed in range(3):
+            with self.subTest(seed=seed):
+                self.assert_matches_replay(self.write(synthetic_gcode(seed)))
+
+    def test_absolute_modes(self):
+        self.assert_matches_replay(
+            self.write(synthetic_gcode(3, relative=False)))
+
+    def test_crlf(self):
+        self.assert_matches_replay(
+            self.write(synthetic_gcode(4, newline="\r\n")))
+
+    def test_indented_mode(self):
+        self.assert_matches_replay(
+            self.write("G28\nG92 E0\nG1 X5\n  G91\nG1 X1\n"))
+
+    def test_indented_setting(self):
+        self.assert_matches_replay(
+            self.write("M104 S190\n  M104 S210\n\tM140 S60\nG28\n"))
+
+    def test_replay_continues_after_scan(self):
+        path = self.write("G28\nG92 E0\nG0 F100\nG91\nG1 X1\n")
+        with open(path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            printer = create_printer()
+            self.assertTrue(scan_state(printer, mm, line_offsets(mm), 5))
+        printer.process_line('G1 X1')
+        self.assertEqual(printer.x, 2.0)
+
+    def test_zhop_walk_is_linear(self):
+        # every mode line passed re-searches one command, not all four
+        for with_m82 in (True, False):
+            with self.subTest(with_m82=with_m82):
+                path = self.write(zhop_gcode(1000, with_m82))
+                with open(path, 'rb') as f, \
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    offsets = line_offsets(mm)
+                    end = len(offsets) - 1
+                    with mock.patch.object(resume_print, 'find_last',
+                                           wraps=resume_print.find_last) as find_last:
+                        self.assertTrue(scan_state(create_printer(), mm, offsets, end))
+                    mode_lines = 2 * 1000 + with_m82
+                    self.assertLessEqual(find_last.call_count, mode_lines + 10)
+                self.assert_matches_replay(path, [end, end // 2, 21])
+
+    @unittest.skipUnless(os.path.exists(BUNDLED_GCODE), 'no bundled gcode')
+    def test_bundled_gcode(self):
+        with open(BUNDLED_GCODE, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            count = len(line_offsets(mm)) - 1
+        ends = random.Random(0).sample(range(count + 1), 40)
+        self.assert_matches_replay(BUNDLED_GCODE, ends + [0, 21, count - 35])
+
+
+if __name__ == '__main__':
+    unittest.main()
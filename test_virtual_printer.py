@@ -0,0 +1,66 @@
+import unittest
+
+from virtual_printer import GCodeInstruction, Parameter, compile_parser
+
+
+class GCodeInstructionTest(unittest.TestCase):
+
+    def test_invalid_parameter_char(self):
+        for char in ('s', '*', '', 'SS'):
+            with self.subTest(char=char):
+                with self.assertRaises(ValueError):
+                    GCodeInstruction('M1', {}, {char: Parameter(char, int)}, None)
+                with self.assertRaises(ValueError):
+                    GCodeInstruction('M1', {char: Parameter(char, int)}, {}, None)
+
+
+class CompileParserTest(unittest.TestCase):
+
+    LINES = ['G1', 'G1 X1', 'G1 X1.5 Y-2 E0.01', 'G1  X1   Y2 ', 'G1 Y2 X1 Y3',
+             'G1 Q5 X1', 'G1 X1 q2', 'G1 N3 S4']
+
+    def instruction(self, required, optional, ignore_unknown=True):
+        return GCodeInstruction(
+            'G1', {c: Parameter(c, t) for c, t in required},
+            {c: Parameter(c, t) for c, t in optional}, None, ignore_unknown)
+
+    def assert_same(self, instr, line):
+        try:
+            expected = instr.parse(line)
+        except RuntimeError as e:
+            with self.assertRaisesRegex(RuntimeError, str(e)):
+                compile_parser(instr)(line.encode())
+        else:
+            self.assertEqual(compile_parser(instr)(line.encode()), expected)
+
+    def test_matches_parse(self):
+        instrs = [
+            self.instruction([], []),
+            self.instruction([], [], ignore_unknown=False),
+            self.instruction([], [('X', float), ('Y', float), ('E', float)]),
+            self.instruction([], [('X', float), ('S', int)], ignore_unknown=False),
+            self.instruction([('X', float)], [('Y', float)]),
+            self.instruction([('X', float), ('Y', float)], [], ignore_unknown=False),
+        ]
+        for instr in instrs:
+            for line in self.LINES:
+                with self.subTest(params=instr._param_table, line=line):
+                    self.assert_same(instr, line)
+
+    def test_unknown_parameter(self):
+        parse = compile_parser(self.instruction([], [('X', float)], ignore_unknown=False))
+        with self.assertRaisesRegex(RuntimeError, 'has no parameter Q'):
+            parse(b'G1 X1 Q2')
+
+    def test_missing_required(self):
+        parse = compile_parser(self.instruction([('S', int)], []))
+        with self.assertRaisesRegex(RuntimeError, 'required arguments missing'):
+            parse(b'G1 X1')
+
+    def test_value_types(self):
+        parse = compile_parser(self.instruction([], [('S', int), ('X', float), ('T', str)]))
+        self.assertEqual(parse(b'G1 S3 X1.25 Tabc'), {'S': 3, 'X': 1.25, 'T': 'abc'})
+
+
+if __name__ == '__main__':
+    unittest.main()
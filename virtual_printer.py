@@ -3,6 +3,8 @@ from typing import Callable, Dict, List, Tuple
 
 class Parameter():
 
+    __slots__ = ('char', 'type')
+
     def __init__(self, char: str, type: type):
         self.char = char
         self.type = type
@@ -10,6 +12,9 @@ class Parameter():
 
 class GCodeInstruction():
 
+    __slots__ = ('cmd', 'required_params', 'optional_params', 'func',
+                 'ignore_unknown', '_param_table', '_required_keys', '_parse')
+
     def __init__(self, cmd, required_params: Dict[str, Parameter], optional_params: Dict[str, Parameter], func: Callable, ignore_unknown=True):
         self.cmd = cmd
         self.required_params = required_params
@@ -17,45 +22,90 @@ class GCodeInstruction():
         self.func = func
         self.ignore_unknown = ignore_unknown
 
-    @property
-    def params(self):
-        params = self.required_params.copy()
-        params.update(self.optional_params)
-        return params
+        # parameters indexed by ord(char) - ord('A')
+        self._param_table = [None] * 26  # type: List[Parameter]
+        for p in {**required_params, **optional_params}.values():
+            if len(p.char) != 1 or not 'A' <= p.char <= 'Z':
+                raise ValueError(
+                    f'{cmd}: parameter must be a letter from A to Z, got {p.char!r}')
+            self._param_table[ord(p.char) - 65] = p
+        self._required_keys = frozenset(required_params)
 
-    @params.setter
-    def params(self, value):
-        raise RuntimeError('params is read only')
+        self._parse = compile_parser(self)
 
     def parse(self, gcode):
-        [cmd, *args] = gcode.split(" ")
+        cmd, _, rest = gcode.partition(" ")
 
         d = {}
-        required = set()
-        for arg in args:
+        for arg in rest.split(" "):
+            if not arg:
+                continue
 
-            if arg[0] not in self.params:
+            ch = arg[0]
+            p = self._param_table[ord(ch) - 65] if 'A' <= ch <= 'Z' else None
+            if p is None:
                 if self.ignore_unknown:
                     continue
                 else:
                     raise RuntimeError(f'{cmd} has no parameter {arg[0]}')
 
-            if arg[0] in self.required_params:
-                required.add(p.char)
-
-            p = self.params[arg[0]]
             d[p.char] = p.type(arg[1:])
 
-        missing = set(self.required_params.keys()) - required
-        if len(missing) != 0:
+        if not self._required_keys.issubset(d.keys()):
+            missing = self._required_keys - d.keys()
             raise RuntimeError(
-                f'required arguments missing for {cmd}: {missing}')
+                f'required arguments missing for {cmd}: {set(missing)}')
 
         return d
 
 
+def compile_parser(instr: GCodeInstruction) -> Callable[[bytes], dict]:
+    # generate a parser with the parameters of instr unrolled into an if chain.
+    # lines are bytes and never decoded unless a parameter type needs it.
+    # invalid lines are handed to instr.parse, which raises the error
+    params = [p for p in instr._param_table if p is not None]
+    namespace = {
+        '_parse': lambda gcode: instr.parse(gcode.decode()),
+        '_required': instr._required_keys,
+    }
+    src = ['def parse(gcode):']
+    if params or not instr.ignore_unknown:
+        src += [
+            '    d = {}',
+            '    for arg in gcode.partition(b" ")[2].split(b" "):',
+            '        ch = arg[:1]',
+        ]
+        for i, p in enumerate(params):
+            value_type = p.type
+            if value_type not in (int, float):
+                value_type = (lambda t: lambda v: t(v.decode()))(p.type)
+            namespace[f'_type_{p.char}'] = value_type
+            src += [
+                f'        {"if" if i == 0 else "elif"} ch == {p.char.encode()!r}:',
+                f'            d[{p.char!r}] = _type_{p.char}(arg[1:])',
+            ]
+        if not instr.ignore_unknown:
+            src.append('        elif ch:' if params else '        if ch:')
+            src.append('            return _parse(gcode)')
+    else:
+        src.append('    d = {}')
+    if instr._required_keys:
+        src += [
+            '    if not _required.issubset(d.keys()):',
+            '        return _parse(gcode)',
+        ]
+    src.append('    return d')
+
+    exec(compile("\n".join(src), f'<parser {instr.cmd}>', 'exec'), namespace)
+    return namespace['parse']
+
+
 class VirtualPrinter():
 
+    __slots__ = ('x', 'y', 'z', 'e', 'feed_rate', 'bed_temp', 'hotend_temp',
+                 'fan_speed', 'ignore_unknown', '_abs_mode', '_abs_e_mode',
+                 '_g_move', 'instruction_set', '_dispatch', '_moves')
+
     def __init__(self, x=None, y=None, z=None, e=None, bed_temp=None, hotend_temp=None, fan_speed=None, feed_rate=None, ignore_unknown=True, abs_mode=True):
 
         self.x = x
@@ -69,34 +119,70 @@ class VirtualPrinter():
         self.fan_speed = fan_speed
 
         self.ignore_unknown = ignore_unknown
-        self.abs_mode = True
-        self.abs_e_mode = True
 
         self.instruction_set = {}  # type: Dict[str, GCodeInstruction]
+        # cmd -> (parse, func), looked up once per line
+        self._dispatch = {}  # type: Dict[bytes, Tuple[Callable, Callable]]
+        # commands registered with g0, dispatched to the variant of g0
+        # matching the current modes
+        self._moves = []  # type: List[Tuple[bytes, Callable]]
+
+        self._abs_mode = True
+        self._abs_e_mode = True
+        self._update_moves()
+
+    @property
+    def abs_mode(self) -> bool:
+        return self._abs_mode
+
+    @abs_mode.setter
+    def abs_mode(self, value: bool):
+        self._abs_mode = value
+        self._update_moves()
+
+    @property
+    def abs_e_mode(self) -> bool:
+        return self._abs_e_mode
+
+    @abs_e_mode.setter
+    def abs_e_mode(self, value: bool):
+        self._abs_e_mode = value
+        self._update_moves()
+
+    def _update_moves(self):
+        self._g_move = _g0_variants[self._abs_mode, self._abs_e_mode]
+        for cmd, parse in self._moves:
+            self._dispatch[cmd] = (parse, self._g_move)
 
     def register_gcode(self, cmd: str, required_params: List[Tuple[str, type]], optional_params: List[Tuple[str, type]], func, ignore_unknown=True):
         required = {p[0]: Parameter(p[0], p[1]) for p in required_params}
         optional = {p[0]: Parameter(p[0], p[1]) for p in optional_params}
-        self.instruction_set[cmd] = GCodeInstruction(
-            cmd, required, optional, func, ignore_unknown)
+        instr = GCodeInstruction(cmd, required, optional, func, ignore_unknown)
+        self.instruction_set[cmd] = instr
+        if func is g0:
+            self._moves.append((cmd.encode(), instr._parse))
+            func = self._g_move
+        self._dispatch[cmd.encode()] = (instr._parse, func)
 
     def process_line(self, gcode: str):
-        if gcode.startswith(';'):
+        self.process_bytes(gcode.encode())
+
+    def process_bytes(self, gcode: bytes):
+        if not gcode or gcode[:1] == b';':
             return
 
-        gcode = gcode.split(';')[0].strip()
+        gcode = gcode.partition(b';')[0].strip()
 
-        [cmd, *_] = gcode.split(" ")
-        if cmd not in self.instruction_set:
+        cmd = gcode.partition(b" ")[0]
+        entry = self._dispatch.get(cmd)
+        if entry is None:
             if self.ignore_unknown:
                 return
             else:
-                raise RuntimeError(f'unknown instruction {cmd}')
-
-        instr = self.instruction_set[cmd]
-        args = instr.parse(gcode)
+                raise RuntimeError(f'unknown instruction {cmd.decode()}')
 
-        instr.func(self, args)
+        parse, func = entry
+        func(self, parse(gcode))
 
     def print_status(self):
         print(f'X:{self.x}, Y:{self.y}, Z:{self.z}, E:{self.e}, Bed:{self.bed_temp}°C, Hotend:{self.hotend_temp}°C, Fan-Speed:{self.fan_speed}')
@@ -127,6 +213,89 @@ def g0(printer: VirtualPrinter, args: dict):
     printer.feed_rate = args.get('F', printer.feed_rate)
 
 
+# g0 specialised for each combination of (abs_mode, abs_e_mode), the printer
+# dispatches commands registered with g0 to the one matching its modes
+
+def _g0_abs_abs(printer: VirtualPrinter, args: dict):
+    x = args.get('X')
+    if x is not None:
+        printer.x = x
+    y = args.get('Y')
+    if y is not None:
+        printer.y = y
+    z = args.get('Z')
+    if z is not None:
+        printer.z = z
+    e = args.get('E')
+    if e is not None:
+        printer.e = e
+    f = args.get('F')
+    if f is not None:
+        printer.feed_rate = f
+
+
+def _g0_abs_rel(printer: VirtualPrinter, args: dict):
+    x = args.get('X')
+    if x is not None:
+        printer.x = x
+    y = args.get('Y')
+    if y is not None:
+        printer.y = y
+    z = args.get('Z')
+    if z is not None:
+        printer.z = z
+    e = args.get('E')
+    if e is not None:
+        printer.e += e
+    f = args.get('F')
+    if f is not None:
+        printer.feed_rate = f
+
+
+def _g0_rel_abs(printer: VirtualPrinter, args: dict):
+    x = args.get('X')
+    if x is not None:
+        printer.x += x
+    y = args.get('Y')
+    if y is not None:
+        printer.y += y
+    z = args.get('Z')
+    if z is not None:
+        printer.z += z
+    e = args.get('E')
+    if e is not None:
+        printer.e = e
+    f = args.get('F')
+    if f is not None:
+        printer.feed_rate = f
+
+
+def _g0_rel_rel(printer: VirtualPrinter, args: dict):
+    x = args.get('X')
+    if x is not None:
+        printer.x += x
+    y = args.get('Y')
+    if y is not None:
+        printer.y += y
+    z = args.get('Z')
+    if z is not None:
+        printer.z += z
+    e = args.get('E')
+    if e is not None:
+        printer.e += e
+    f = args.get('F')
+    if f is not None:
+        printer.feed_rate = f
+
+
+_g0_variants = {
+    (True, True): _g0_abs_abs,
+    (True, False): _g0_abs_rel,
+    (False, True): _g0_rel_abs,
+    (False, False): _g0_rel_rel,
+}
+
+
 def m104(printer: VirtualPrinter, args: dict):
     printer.hotend_temp = args.get('S', printer.hotend_temp)
 